@@ -1,7 +1,8 @@
+import numpy as np
 import pandas as pd
 import re
-from dateutil import parser
 from rapidfuzz import process, fuzz
+import xlsxwriter
 
 # =========================
 # FILE PATHS
@@ -16,71 +17,151 @@ OUTPUT_FILE = "Master_Client_Reconciliation.xlsx"
 # =========================
 # HELPERS
 # =========================
-def parse_date(val):
-    try:
-        return parser.parse(str(val)).date()
-    except Exception:
-        return None
-
-def normalize_name(name):
-    if pd.isna(name):
-        return ""
-    name = str(name).lower()
-    name = re.sub(r"[^\w\s]", "", name)
-    parts = [p.strip() for p in name.split(",")]
-    if len(parts) == 2:
-        name = f"{parts[1]} {parts[0]}"
-    return re.sub(r"\s+", " ", name).strip()
-
-def first_non_null(s):
-    s = s.dropna()
-    return s.iloc[0] if not s.empty else pd.NA
-
-def fuzzy_match(row, lookup_df, threshold=90):
-    # 1) Insurance ID exact match
-    if pd.notna(row["Insurance ID"]):
-        hit = lookup_df[lookup_df["Insurance ID"] == row["Insurance ID"]]
-        if not hit.empty:
-            return hit.iloc[0]
-
-    # 2) Fuzzy name fallback
-    match = process.extractOne(
-        row["norm_name"],
-        lookup_df["norm_name"],
-        scorer=fuzz.token_sort_ratio
+# Compiled once; compiled patterns also keep Python's Unicode \w on
+# Arrow-backed string columns
+_RE_PUNCT = re.compile(r"[^\w\s]")
+_RE_WS = re.compile(r"\s+")
+_RE_BAD_STATUS = re.compile(r"cancel|no show|noshow")
+
+def normalize_series(names):
+    names = names.fillna("").astype(str).str.lower()
+    names = names.str.replace(_RE_PUNCT, "", regex=True)
+    return names.str.replace(_RE_WS, " ", regex=True).str.strip()
+
+def sort_tokens(names):
+    # token_sort_ratio's preprocessing, done once per name instead of per pair
+    return names.map(lambda name: " ".join(sorted(name.split())))
+
+def block_positions(names):
+    # Block key -> positions of the names in that block
+    keys = pd.Series(names, dtype=object).str[:2]
+    return keys.groupby(keys, sort=False).indices
+
+def best_matches(queries, choices, threshold):
+    scores = process.cdist(
+        queries.tolist(),
+        choices.tolist(),
+        scorer=fuzz.ratio,
+        score_cutoff=threshold,
+        dtype=np.uint8,
+        workers=-1
     )
-    if match and match[1] >= threshold:
-        return lookup_df.loc[lookup_df["norm_name"] == match[0]].iloc[0]
+    # Scores below the cutoff are already 0, so uint8 rounding cannot
+    # push a miss over the threshold
+    best_idx = scores.argmax(axis=1)
+    best_score = scores[np.arange(len(scores)), best_idx]
+    del scores
+    return best_idx, best_score
+
+def match_status(ins_ids, queries, lookup_df, threshold=90):
+    # 1) Insurance ID exact match — one hash probe per row against an
+    #    ID -> Status index built once per lookup table
+    by_id = (
+        lookup_df[["Insurance ID", "Status"]]
+        .dropna(subset=["Insurance ID"])
+        .drop_duplicates(subset=["Insurance ID"], keep="first")
+        .set_index("Insurance ID")["Status"]
+    )
+    pos = by_id.index.get_indexer(ins_ids)
+    id_hit = pos >= 0
+
+    status = np.full(len(ins_ids), pd.NA, dtype=object)
+    status[id_hit] = by_id.to_numpy(dtype=object)[pos[id_hit]]
+
+    # 2) Fuzzy name fallback, only for named rows the ID lookup missed,
+    #    against one candidate per distinct lookup name (first row wins)
+    need_fuzzy = ~id_hit & (queries != "")
+    choices = (
+        lookup_df.loc[lookup_df["sorted_name"].ne(""), ["sorted_name", "Status"]]
+        .drop_duplicates(subset=["sorted_name"], keep="first")
+    )
+    if need_fuzzy.any() and not choices.empty:
+        fuzzy_rows = np.flatnonzero(need_fuzzy)
+        fuzzy_names = queries[fuzzy_rows]
+        choice_names = choices["sorted_name"].to_numpy(dtype=object)
+        lookup_status = choices["Status"].to_numpy(dtype=object)
+
+        # Blocking: first compare names sharing the first two characters of
+        # the token-sorted name. Queries whose block is empty or has no
+        # candidate reaching the threshold are rescored against every
+        # candidate, so blocking never drops a match
+        choice_blocks = block_positions(choice_names)
+        misses = []
+        for key, q_pos in block_positions(fuzzy_names).items():
+            c_pos = choice_blocks.get(key)
+            if c_pos is None:
+                misses.append(q_pos)
+                continue
+
+            best_idx, best_score = best_matches(
+                fuzzy_names[q_pos], choice_names[c_pos], threshold
+            )
+            hit = best_score >= threshold
+            status[fuzzy_rows[q_pos[hit]]] = lookup_status[c_pos[best_idx[hit]]]
+            misses.append(q_pos[~hit])
+
+        q_pos = np.concatenate(misses)
+        if len(q_pos):
+            best_idx, best_score = best_matches(
+                fuzzy_names[q_pos], choice_names, threshold
+            )
+            hit = best_score >= threshold
+            status[fuzzy_rows[q_pos[hit]]] = lookup_status[best_idx[hit]]
+
+    return status
+
+def write_xlsx(df, target, sheet_name="Sheet1"):
+    # constant_memory flushes each row as soon as the next one starts, so rows
+    # are written in order here (pandas' to_excel writes column by column).
+    # datetime64 columns go out as Excel dates in the default date format.
+    workbook = xlsxwriter.Workbook(target, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd"
+    })
+    sheet = workbook.add_worksheet(sheet_name)
+    sheet.write_row(0, 0, df.columns, workbook.add_format({"bold": True}))
+
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False)
+    for i, row in enumerate(rows, start=1):
+        sheet.write_row(i, 0, row)
 
-    return None
+    workbook.close()
 
 # =========================
 # LOAD FILES
 # =========================
-aloha1 = pd.read_excel(ALOHA1_FILE)
-aloha2 = pd.read_excel(ALOHA2_FILE)
-zoho = pd.read_excel(ZOHO_FILE)
-hirasmus = pd.read_excel(HIRASMUS_FILE)
+aloha1 = pd.read_excel(ALOHA1_FILE, engine="calamine")
+aloha2 = pd.read_excel(ALOHA2_FILE, engine="calamine")
+zoho = pd.read_excel(ZOHO_FILE, engine="calamine")
+hirasmus = pd.read_excel(HIRASMUS_FILE, engine="calamine")
 
 # Normalize Client ID column name
 aloha2 = aloha2.rename(columns={"Client Id": "Client ID"})
 
+# Categorical keys hash as small integer codes in the groupbys/merges below
+aloha1["Client ID"] = aloha1["Client ID"].astype("category")
+aloha1["Insurance ID"] = aloha1["Insurance ID"].astype("category")
+aloha2["Client ID"] = aloha2["Client ID"].astype("category")
+
 # =========================
 # STEP 1: LAST DATE OF SERVICE (ALOHA1)
 # =========================
-aloha1["Appt. Date"] = aloha1["Appt. Date"].apply(parse_date)
+# Day only: any time of day is truncated, as a date is all we report
+aloha1["Appt. Date"] = pd.to_datetime(
+    aloha1["Appt. Date"], format="mixed", errors="coerce"
+).dt.normalize()
 
-appts = aloha1.dropna(subset=["Insurance ID", "Appt. Date"]).copy()
+appts = aloha1.dropna(subset=["Insurance ID", "Appt. Date"])
 
 if "Status" in appts.columns:
     bad = appts["Status"].astype(str).str.lower().str.contains(
-        r"cancel|no show|noshow", na=False
+        _RE_BAD_STATUS, na=False
     )
     appts = appts[~bad]
 
 last_service = (
     appts
-    .groupby("Insurance ID", as_index=False)["Appt. Date"]
+    .groupby("Insurance ID", as_index=False, sort=False, observed=True)["Appt. Date"]
     .max()
     .rename(columns={"Appt. Date": "Last Date of Service"})
 )
@@ -89,46 +170,44 @@ last_service = (
 # STEP 2: BUILD ALOHA MAIN
 # =========================
 insurance_map = (
-    aloha1[["Client ID", "Insurance ID"]]
-    .drop_duplicates(subset=["Client ID"], keep="first")
+    aloha1
+    .groupby("Client ID", as_index=False, sort=False, observed=True)["Insurance ID"]
+    .first()
 )
 
-aloha_main = aloha2.merge(insurance_map, on="Client ID", how="left")
-
 aloha_main = (
-    aloha_main
-    .groupby("Client ID", as_index=False)
+    aloha2
+    .groupby("Client ID", as_index=False, sort=False, observed=True)
     .agg({
-        "Client": first_non_null,
-        "Insurance ID": first_non_null,
-        "Status": first_non_null
+        "Client": "first",
+        "Status": "first"
     })
     .rename(columns={"Status": "Aloha Status"})
 )
 
+aloha_main = aloha_main.merge(insurance_map, on="Client ID", how="left")
+
 aloha_main = aloha_main.merge(last_service, on="Insurance ID", how="left")
-aloha_main["norm_name"] = aloha_main["Client"].apply(normalize_name)
+aloha_main["norm_name"] = normalize_series(aloha_main["Client"])
+aloha_main["sorted_name"] = sort_tokens(aloha_main["norm_name"])
 
 # =========================
 # STEP 3: PREP ZOHO & HIRASMUS
 # =========================
-zoho["norm_name"] = zoho["Client"].apply(normalize_name)
-hirasmus["norm_name"] = hirasmus["Client"].apply(normalize_name)
+zoho["norm_name"] = normalize_series(zoho["Client"])
+zoho["sorted_name"] = sort_tokens(zoho["norm_name"])
+hirasmus["norm_name"] = normalize_series(hirasmus["Client"])
+hirasmus["sorted_name"] = sort_tokens(hirasmus["norm_name"])
 
 # =========================
 # STEP 4: ATTACH STATUSES (ID → FUZZY)
 # =========================
-zoho_status = []
-for _, row in aloha_main.iterrows():
-    z = fuzzy_match(row, zoho)
-    zoho_status.append(z["Status"] if z is not None else pd.NA)
-aloha_main["Zoho Status"] = zoho_status
+# Query side is prepared once and shared by both lookups
+ins_ids = aloha_main["Insurance ID"]
+queries = aloha_main["sorted_name"].to_numpy(dtype=object)
 
-hirasmus_status = []
-for _, row in aloha_main.iterrows():
-    h = fuzzy_match(row, hirasmus)
-    hirasmus_status.append(h["Status"] if h is not None else pd.NA)
-aloha_main["HiRasmus Status"] = hirasmus_status
+aloha_main["Zoho Status"] = match_status(ins_ids, queries, zoho)
+aloha_main["HiRasmus Status"] = match_status(ins_ids, queries, hirasmus)
 
 # =========================
 # FINAL EXPORT
@@ -141,7 +220,7 @@ final = aloha_main[[
     "HiRasmus Status"
 ]]
 
-final.to_excel(OUTPUT_FILE, index=False)
+write_xlsx(final, OUTPUT_FILE)
 
 print("✅ Master reconciliation file created")
 print(f"Unique clients exported: {len(final)}")